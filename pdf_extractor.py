@@ -1,81 +1,124 @@
 import fitz  # PyMuPDF
 import os
-import json
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import repeat
 from collections import Counter
-import unicodedata
+
+try:
+    import orjson  # Optional: much faster JSON encoding
+except ImportError:
+    orjson = None
+    import json  # Only needed as the fallback encoder
 
 INPUT_DIR = "input"
 OUTPUT_DIR = "output"
+MIN_PAGES_PER_WORKER = 32  # Smaller page ranges don't pay for a worker process
+HEADING_SAMPLE_PAGES = 20  # Leading pages used to bound the heading sizes
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Same flags as get_text("dict") but without image extraction, which the
+# outline never looks at
+_TP_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# Codepoint -> tag table for script detection; tags are non-alphabetic so
+# they are not counted as Latin, and any tag characters already in the text
+# are deleted so they can't be counted as a script
+_CJK_TAG, _ARABIC_TAG, _DEVANAGARI_TAG, _CYRILLIC_TAG = '\x01', '\x02', '\x03', '\x04'
+_SCRIPT_RANGES = (
+    (0x4e00, 0x9fff, _CJK_TAG),  # CJK Unified Ideographs
+    (0x3040, 0x309f, _CJK_TAG),  # Hiragana
+    (0x30a0, 0x30ff, _CJK_TAG),  # Katakana
+    (0xac00, 0xd7af, _CJK_TAG),  # Hangul
+    (0x0600, 0x06ff, _ARABIC_TAG),
+    (0x0750, 0x077f, _ARABIC_TAG),
+    (0x0900, 0x097f, _DEVANAGARI_TAG),
+    (0x0400, 0x04ff, _CYRILLIC_TAG),
+)
+_SCRIPT_TABLE = {
+    cp: tag for lo, hi, tag in _SCRIPT_RANGES for cp in range(lo, hi + 1)
+}
+_SCRIPT_TABLE.update({ord(t): None for t in (_CJK_TAG, _ARABIC_TAG, _DEVANAGARI_TAG, _CYRILLIC_TAG)})
+
+# Precompiled patterns used on every span
+_CJK_GAP_RE = re.compile(r'(?<=[\u4e00-\u9fff\u3040-\u309f\u30a0-\u30ff])\s+(?=[\u4e00-\u9fff\u3040-\u309f\u30a0-\u30ff])')
+_ARABIC_PUNCT_RE = re.compile(r'\s*([،؛؟])\s*')
+
+# Heading patterns, written as alternations for re.VERBOSE
+_SCRIPT_HEADING_PATTERNS = {
+    # CJK headings often have chapter markers and numbering patterns
+    "cjk": r'''
+      第[一二三四五六七八九十\d]+章  # Chapter in Chinese/Japanese
+    | 第[一二三四五六七八九十\d]+節  # Section
+    | \d+[\.\s]                    # Numbered sections
+    | [一二三四五六七八九十]+[\.\s]  # Chinese numerals
+''',
+    "arabic": r'''
+      الفصل\s+[\d]+  # Chapter
+    | الباب\s+[\d]+  # Section
+    | \d+[\.\s]      # Numbered
+''',
+    "devanagari": r'''
+      अध्याय\s+[\d]+  # Chapter
+    | भाग\s+[\d]+     # Part
+    | \d+[\.\s]       # Numbered
+''',
+}
+# Common patterns across scripts
+_COMMON_HEADING_PATTERNS = r'''
+      \d+[\.\s]           # 1. or 1
+    | [A-Z][a-z]*\s+\d+   # Chapter 1, Section 2, etc.
+    | [IVX]+[\.\s]        # Roman numerals
+'''
+# One regex per script covering its own and the common patterns, so a span
+# is checked with a single match()
+_HEADING_RES = {
+    script: re.compile(patterns + '|' + _COMMON_HEADING_PATTERNS, re.VERBOSE)
+    for script, patterns in _SCRIPT_HEADING_PATTERNS.items()
+}
+_COMMON_HEADING_RE = re.compile(_COMMON_HEADING_PATTERNS, re.VERBOSE)
 
 def detect_language_script(text):
     """Detect the script/language family of text"""
     if not text:
         return "latin"
     
-    # Count characters by Unicode blocks
+    # Tag every script character in one C-level pass, then count the tags
+    tagged = text.translate(_SCRIPT_TABLE)
     script_counts = {
-        'latin': 0,
-        'cjk': 0,  # Chinese, Japanese, Korean
-        'arabic': 0,
-        'devanagari': 0,  # Hindi
-        'cyrillic': 0
+        'cjk': tagged.count(_CJK_TAG),  # Chinese, Japanese, Korean
+        'arabic': tagged.count(_ARABIC_TAG),
+        'devanagari': tagged.count(_DEVANAGARI_TAG),  # Hindi
+        'cyrillic': tagged.count(_CYRILLIC_TAG),
     }
+    # Latin (default for most European languages): any other alphabetic char
+    latin = sum(map(str.isalpha, tagged))
     
-    for char in text:
-        # Get Unicode category and name
-        try:
-            unicode_name = unicodedata.name(char, '')
-            
-            # CJK characters (Chinese, Japanese, Korean)
-            if ('\u4e00' <= char <= '\u9fff' or  # CJK Unified Ideographs
-                '\u3040' <= char <= '\u309f' or  # Hiragana
-                '\u30a0' <= char <= '\u30ff' or  # Katakana
-                '\uac00' <= char <= '\ud7af'):   # Hangul
-                script_counts['cjk'] += 1
-            
-            # Arabic script
-            elif '\u0600' <= char <= '\u06ff' or '\u0750' <= char <= '\u077f':
-                script_counts['arabic'] += 1
-            
-            # Devanagari (Hindi)
-            elif '\u0900' <= char <= '\u097f':
-                script_counts['devanagari'] += 1
-            
-            # Cyrillic
-            elif '\u0400' <= char <= '\u04ff':
-                script_counts['cyrillic'] += 1
-            
-            # Latin (default for most European languages)
-            elif char.isalpha():
-                script_counts['latin'] += 1
-        except:
-            continue
-    
-    # Return the script with highest count
-    return max(script_counts, key=script_counts.get)
+    # Return the script with highest count, Latin winning ties
+    script = max(script_counts, key=script_counts.get)
+    return script if script_counts[script] > latin else "latin"
 
+@lru_cache(maxsize=4096)
 def clean_text(text, script_type="latin"):
     """Clean text based on detected script type"""
     if not text:
         return ""
     
+    # Collapse whitespace runs; split/join does this in C, without the
+    # regex engine, and leaves no leading or trailing whitespace
+    text = ' '.join(text.split())
+    
     if script_type == "cjk":
         # For CJK languages, preserve spacing differently
-        # Remove excessive whitespace but be more careful with CJK punctuation
-        text = re.sub(r'\s+', ' ', text)
         # Remove spaces around CJK characters if they seem unnecessary
-        text = re.sub(r'(?<=[\u4e00-\u9fff\u3040-\u309f\u30a0-\u30ff])\s+(?=[\u4e00-\u9fff\u3040-\u309f\u30a0-\u30ff])', '', text)
+        text = _CJK_GAP_RE.sub('', text)
     elif script_type == "arabic":
         # Arabic text flows right-to-left, handle spacing carefully
-        text = re.sub(r'\s+', ' ', text)
         # Remove extra spaces around Arabic punctuation
-        text = re.sub(r'\s*([،؛؟])\s*', r'\1 ', text)
-    else:
-        # Default cleaning for Latin and other scripts
-        text = re.sub(r'\s+', ' ', text)
+        text = _ARABIC_PUNCT_RE.sub(r'\1 ', text).strip()
     
-    return text.strip()
+    return text
 
 def is_likely_heading(text, font_size, avg_font_size, script_type="latin"):
     """Enhanced heading detection considering multilingual aspects"""
@@ -86,47 +129,8 @@ def is_likely_heading(text, font_size, avg_font_size, script_type="latin"):
     if font_size <= avg_font_size:
         return False
     
-    # Script-specific heading patterns
-    if script_type == "cjk":
-        # CJK headings often have specific patterns
-        # Check for chapter markers, numbering patterns
-        cjk_heading_patterns = [
-            r'^第[一二三四五六七八九十\d]+章',  # Chapter in Chinese/Japanese
-            r'^第[一二三四五六七八九十\d]+節',  # Section
-            r'^\d+[\.\s]',  # Numbered sections
-            r'^[一二三四五六七八九十]+[\.\s]',  # Chinese numerals
-        ]
-        if any(re.match(pattern, text) for pattern in cjk_heading_patterns):
-            return True
-    
-    elif script_type == "arabic":
-        # Arabic heading patterns
-        arabic_heading_patterns = [
-            r'^الفصل\s+[\d]+',  # Chapter
-            r'^الباب\s+[\d]+',  # Section
-            r'^\d+[\.\s]',  # Numbered
-        ]
-        if any(re.match(pattern, text) for pattern in arabic_heading_patterns):
-            return True
-    
-    elif script_type == "devanagari":
-        # Hindi heading patterns
-        hindi_heading_patterns = [
-            r'^अध्याय\s+[\d]+',  # Chapter
-            r'^भाग\s+[\d]+',     # Part
-            r'^\d+[\.\s]',       # Numbered
-        ]
-        if any(re.match(pattern, text) for pattern in hindi_heading_patterns):
-            return True
-    
-    # Common patterns across scripts
-    common_patterns = [
-        r'^\d+[\.\s]',  # 1. or 1 
-        r'^[A-Z][a-z]*\s+\d+',  # Chapter 1, Section 2, etc.
-        r'^[IVX]+[\.\s]',  # Roman numerals
-    ]
-    
-    if any(re.match(pattern, text) for pattern in common_patterns):
+    # Script-specific and common heading patterns
+    if _HEADING_RES.get(script_type, _COMMON_HEADING_RE).match(text):
         return True
     
     # Length-based filtering (adjust for different scripts)
@@ -136,41 +140,58 @@ def is_likely_heading(text, font_size, avg_font_size, script_type="latin"):
     
     return True
 
-def extract_spans_from_page(page, height_thresholds=(0.1, 0.9)):
+def extract_spans_from_page(page, height_thresholds=(0.1, 0.9), min_size=0):
+    """Return the page's spans as (size, page, text, line_text) tuples, plus
+    a Counter of the sizes of all its spans.
+    
+    Sizes are integer tenths of a point (deci-points). Spans smaller than
+    min_size are counted but not returned. Text is left raw; cleaning and
+    script detection (from the whole line) are deferred until a span turns
+    out to be a heading candidate.
+    """
     page_height = page.rect.height
+    lo = height_thresholds[0] * page_height
+    hi = height_thresholds[1] * page_height
+    # Locals for the per-span loop; page.number goes through a property
+    page_no = page.number
     spans = []
-    blocks = page.get_text("dict")["blocks"]
+    append = spans.append
+    size_counts = Counter()
+    tp = page.get_textpage(flags=_TP_FLAGS)
+    blocks = tp.extractDICT()["blocks"]
+    tp = None
     
     for block in blocks:
         for line in block.get("lines", []):
-            for span in line.get("spans", []):
-                text = span.get("text", "")
-                if not text:
+            line_spans = line.get("spans", [])
+            line_text = None
+            
+            for span in line_spans:
+                # Skip headers/footers before looking at the text at all
+                top_y = span["bbox"][1]
+                if not (lo <= top_y <= hi):
                     continue
                 
-                # Detect script type for this span
-                script_type = detect_language_script(text)
-                cleaned_text = clean_text(text, script_type)
-                
-                if not cleaned_text:
+                text = span.get("text", "")
+                # Whitespace-only spans would clean to nothing
+                if not text or text.isspace():
                     continue
                 
-                top_y = span["bbox"][1]
-                if not (height_thresholds[0] * page_height <= top_y <= height_thresholds[1] * page_height):
+                size = int(span["size"] * 10 + 0.5)
+                size_counts[size] += 1
+                if size < min_size:
                     continue
                 
-                spans.append({
-                    "text": cleaned_text,
-                    "size": round(span["size"], 1),
-                    "page": page.number,
-                    "script_type": script_type,
-                    "font": span.get("font", ""),
-                    "flags": span.get("flags", 0)  # Font style flags
-                })
-    
-    return spans
+                # Only build the line text for lines that keep a span
+                if line_text is None:
+                    line_text = "".join(s.get("text", "") for s in line_spans)
+                append((size, page_no, text, line_text))
+    
+    return spans, size_counts
 
-def group_font_sizes_by_tolerance(sizes, tolerance=0.5):
+def group_font_sizes_by_tolerance(sizes, tolerance=5):
+    # Sizes and tolerance are in deci-points. Only the distinct sizes are
+    # sorted; there are few of them even when there are many spans
     sorted_sizes = sorted(set(sizes), reverse=True)
     grouped = []
     
@@ -182,11 +203,12 @@ def group_font_sizes_by_tolerance(sizes, tolerance=0.5):
     
     return grouped
 
-def assign_font_to_heading_levels(font_groups, spans):
+def assign_font_to_heading_levels(font_groups, size_counts):
     font_to_level = {}
     
-    # Calculate average font size for heading detection
-    avg_font_size = sum(span["size"] for span in spans) / len(spans) if spans else 12
+    # Calculate average font size (deci-points) for heading detection
+    n_spans = sum(size_counts.values())
+    avg_font_size = sum(size * n for size, n in size_counts.items()) / n_spans if n_spans else 120
     
     for i, group in enumerate(font_groups):
         level = f"H{i+1}" if i < 4 else None
@@ -196,73 +218,170 @@ def assign_font_to_heading_levels(font_groups, spans):
     
     return font_to_level, avg_font_size
 
-def extract_outline(pdf_path):
+def min_heading_size(size_counts, tolerance=5):
+    """Lower bound on the size of any heading, from a subset of the sizes.
+    
+    Adding sizes can only raise the leaders of the first four groups, so
+    no H1-H4 size can be smaller than the fourth leader here minus the
+    tolerance. With fewer than four groups there is no bound.
+    """
+    groups = group_font_sizes_by_tolerance(size_counts, tolerance)
+    return groups[3][0] - tolerance if len(groups) >= 4 else 0
+
+def _init_worker():
+    # MuPDF warnings on stderr are just noise here; real failures still raise
+    fitz.TOOLS.mupdf_display_errors(False)
+
+def _open_document(pdf_path):
+    # Read the file in one go so MuPDF parses from memory instead of
+    # issuing small reads against the file
+    with open(pdf_path, "rb") as fh:
+        data = fh.read()
+    return fitz.open(stream=data, filetype="pdf")
+
+def _close_document(doc):
+    doc.close()
+    # Empty MuPDF's object store so cached images and fonts from this
+    # document don't stay resident while the worker moves on
+    fitz.TOOLS.store_shrink(100)
+
+def _extract_spans_from_range(pdf_path, start, stop, min_size=0):
+    # Open by path: this worker only parses its own pages, so buffering the
+    # whole file in every worker would multiply peak memory
     doc = fitz.open(pdf_path)
+    spans = []
+    size_counts = Counter()
+    
+    for i in range(start, stop):
+        page_spans, page_counts = extract_spans_from_page(doc.load_page(i), min_size=min_size)
+        spans.extend(page_spans)
+        size_counts.update(page_counts)
+    
+    _close_document(doc)
+    return spans, size_counts
+
+def extract_outline(pdf_path, page_workers=1):
+    doc = _open_document(pdf_path)
+    n_pages = doc.page_count
+    n_sample = min(HEADING_SAMPLE_PAGES, n_pages)
+    
+    # Font sizes are counted while collecting, so grouping and the average
+    # only need the distinct sizes
     all_spans = []
+    size_counts = Counter()
     
-    for page in doc:
-        all_spans.extend(extract_spans_from_page(page))
+    # Keep every span of the first pages; their sizes bound what can still
+    # be a heading, so later pages only keep spans above that bound
+    for i in range(n_sample):
+        spans, counts = extract_spans_from_page(doc.load_page(i))
+        all_spans.extend(spans)
+        size_counts.update(counts)
+    min_size = min_heading_size(size_counts)
     
-    if not all_spans:
-        doc.close()
+    n_rest = n_pages - n_sample
+    workers = min(page_workers, n_rest // MIN_PAGES_PER_WORKER)
+    if workers > 1:
+        # MuPDF is not thread-safe, so split the pages across processes that
+        # each open their own copy of the document
+        bounds = [n_sample + n_rest * i // workers for i in range(workers + 1)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as ex:
+            results = list(ex.map(_extract_spans_from_range, repeat(pdf_path), bounds[:-1], bounds[1:], repeat(min_size)))
+    else:
+        results = (extract_spans_from_page(doc.load_page(i), min_size=min_size) for i in range(n_sample, n_pages))
+    
+    for spans, counts in results:
+        all_spans.extend(spans)
+        size_counts.update(counts)
+    
+    if not size_counts:
+        _close_document(doc)
         return {"title": "Untitled", "outline": []}
     
-    all_font_sizes = [span["size"] for span in all_spans]
-    grouped_sizes = group_font_sizes_by_tolerance(all_font_sizes)
-    font_to_level, avg_font_size = assign_font_to_heading_levels(grouped_sizes, all_spans)
+    grouped_sizes = group_font_sizes_by_tolerance(size_counts)
+    font_to_level, avg_font_size = assign_font_to_heading_levels(grouped_sizes, size_counts)
+    
+    # is_likely_heading rejects anything not above the average size, so only
+    # look up levels for sizes that can pass
+    heading_levels = {size: level for size, level in font_to_level.items() if size > avg_font_size}
     
     outline = []
     title = None
+    # Largest span on the first page, for the fallback title
+    best_p0 = None
+    best_p0_size = -1
     
     for span in all_spans:
-        level = font_to_level.get(span["size"])
-        if level and is_likely_heading(span["text"], span["size"], avg_font_size, span["script_type"]):
+        size, page_no, text, line_text = span
+        if page_no == 0 and size > best_p0_size:
+            best_p0, best_p0_size = span, size
+        
+        level = heading_levels.get(size)
+        if not level:
+            continue
+        
+        script_type = detect_language_script(line_text)
+        text = clean_text(text, script_type)
+        if is_likely_heading(text, size, avg_font_size, script_type):
             outline.append({
                 "level": level,
-                "text": span["text"],
-                "page": span["page"] + 1  # Convert to 1-based page numbering
+                "text": text,
+                "page": page_no + 1  # Convert to 1-based page numbering
             })
             
             # Try to find title from first page, largest font
-            if not title and span["page"] == 0 and level == "H1":
-                title = span["text"]
+            if not title and page_no == 0 and level == "H1":
+                title = text
     
     # Fallback title detection
-    if not title:
-        page_1_spans = [s for s in all_spans if s["page"] == 0]
-        if page_1_spans:
-            # Find the largest font on page 1 that looks like a title
-            title_candidate = max(page_1_spans, key=lambda s: s["size"])
-            title = title_candidate["text"]
+    if not title and best_p0:
+        # Use the largest font on page 1 as the title
+        _, _, text, line_text = best_p0
+        title = clean_text(text, detect_language_script(line_text))
     
-    doc.close()
+    _close_document(doc)
     
     return {
         "title": title or "Untitled",
         "outline": outline
     }
 
+def _process_one(filename, page_workers=1):
+    input_path = os.path.join(INPUT_DIR, filename)
+    output_path = os.path.join(OUTPUT_DIR, filename.replace(".pdf", ".json"))
+    
+    data = extract_outline(input_path, page_workers)
+    if orjson is not None:
+        # orjson writes UTF-8 without escaping, same output as below
+        with open(output_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        # Use ensure_ascii=False to properly handle non-ASCII characters
+        with open(output_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
 def main():
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     
-    pdf_files = [f for f in os.listdir(INPUT_DIR) if f.lower().endswith(".pdf")]
+    # scandir reuses the directory entry's type instead of a stat per file
+    with os.scandir(INPUT_DIR) as it:
+        pdf_files = [e.name for e in it if e.is_file() and e.name.lower().endswith(".pdf")]
     
     if not pdf_files:
         print("No PDF files found in input directory")
         return
     
-    for filename in pdf_files:
-        input_path = os.path.join(INPUT_DIR, filename)
-        output_path = os.path.join(OUTPUT_DIR, filename.replace(".pdf", ".json"))
-        
-        try:
-            data = extract_outline(input_path)
-            # Use ensure_ascii=False to properly handle non-ASCII characters
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-            print(f"✔ Processed {filename}")
-        except Exception as e:
-            print(f"✖ Failed to process {filename}: {e}")
+    # PDFs are independent, so process them in parallel across cores; cores
+    # left over when there are few PDFs go to splitting their pages
+    page_workers = max(1, (os.cpu_count() or 1) // len(pdf_files))
+    with ProcessPoolExecutor(initializer=_init_worker) as ex:
+        futures = {ex.submit(_process_one, filename, page_workers): filename for filename in pdf_files}
+        for fut in as_completed(futures):
+            filename = futures[fut]
+            try:
+                fut.result()
+                print(f"✔ Processed {filename}")
+            except Exception as e:
+                print(f"✖ Failed to process {filename}: {e}")
 
 if __name__ == "__main__":
     main()